@@ -1,98 +1,348 @@
 import asyncio
 import websockets
 import json
+import logging
+import logging.handlers
 import os
+import signal
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
+from queue import SimpleQueue
+from time import time
 from dotenv import load_dotenv
 
+try:
+    import uvloop
+except ImportError:  # Optional (not available on Windows); use the default loop
+    uvloop = None
+
+try:
+    import orjson
+except ImportError:  # Optional; fall back to the stdlib json module
+    orjson = None
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Only needed when REDIS_URL is set
+    aioredis = None
+
 # Load environment variables (for local testing)
 load_dotenv()
 
 # --- Configuration ---
-PORT = int(os.environ.get("PORT", 8765)) 
+try:
+    PORT = int(os.environ.get("PORT", 8765)) 
+except ValueError:
+    PORT = None
+if PORT is None or not 0 < PORT < 65536:
+    raise SystemExit(f"[FATAL] Invalid PORT {os.environ.get('PORT')!r}")
 HOST = "0.0.0.0" 
+MAX_MSG_BYTES = 4096  # Larger incoming frames are refused before they are parsed
+MAX_USERNAME_LENGTH = 24  # Matches the client, which also caps messages at 1000 chars
+REDIS_URL = os.environ.get("REDIS_URL")  # Share history and broadcasts across instances
+REDIS_HISTORY_KEY = "chat:history"
+REDIS_CHANNEL = "chat:broadcast"
+REDIS_RETRY_SECONDS = 2  # Pause before resubscribing after losing Redis
+
+# --- Logging ---
+# Records are handed to a background thread so the event loop never waits on stdout
+LOG_QUEUE = SimpleQueue()
+logger = logging.getLogger("chat")
+logger.setLevel(logging.INFO)
+logger.addHandler(logging.handlers.QueueHandler(LOG_QUEUE))
+_log_output = logging.StreamHandler()
+_log_output.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+LOG_LISTENER = logging.handlers.QueueListener(LOG_QUEUE, _log_output)
 
 # --- Global State ---
-CONNECTIONS = set()
+CONNECTIONS = {}  # id(websocket) -> (websocket, send queue, writer task)
+CONNECTIONS_SNAPSHOT = ()  # CONNECTIONS.values(), rebuilt only when clients come or go
 MAX_HISTORY = 50
-CHAT_HISTORY = []
+SEND_QUEUE_SIZE = 64  # Clients this far behind are dropped instead of buffered
+SEND_TIMEOUT = 5.0  # Seconds a single send may wait on a client before it is dropped
+CHAT_HISTORY_JSON = deque(maxlen=MAX_HISTORY)  # Pre-encoded chat messages
+HISTORY_BLOB = None  # Cached history frame, rebuilt lazily after each new message
+HISTORY_JOB = None  # In-flight compression of HISTORY_BLOB, shared by concurrent callers
+COMPRESSION_LEVEL = 1  # Outgoing frames are zlib-compressed once, not per connection
+COMPRESS_OFFLOAD_BYTES = 64 * 1024  # Larger frames are compressed off the event loop
+COMPRESS_POOL = ThreadPoolExecutor(max_workers=2)
+REDIS = None  # Redis client when running as one of several instances
+SHUTTING_DOWN = False  # Set on SIGTERM so no new work starts while the server closes
 
 # --- Core Server Logic ---
 
-async def register(websocket):
-    """Adds a new client and sends history."""
-    CONNECTIONS.add(websocket)
-    print(f"[INFO] Client connected from {websocket.remote_address}. Total: {len(CONNECTIONS)}")
-    
+# Messages are kept as UTF-8 bytes from encoding through compression and Redis
+if orjson is not None:
+    encode_json = orjson.dumps
+    decode_json = orjson.loads  # Raises a json.JSONDecodeError subclass
+else:
+    def encode_json(obj):
+        return json.dumps(obj).encode("utf-8")
+    decode_json = json.loads
+
+async def compress(message_json):
+    """Compresses an outgoing JSON frame; clients inflate binary frames."""
+    if len(message_json) < COMPRESS_OFFLOAD_BYTES:
+        return zlib.compress(message_json, COMPRESSION_LEVEL)
+
+    # zlib releases the GIL, so big frames compress without stalling the loop
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(COMPRESS_POOL, zlib.compress, message_json, COMPRESSION_LEVEL)
+
+async def history_blob():
+    """Returns the whole (non-empty) chat history as a single compressed frame."""
+    global HISTORY_BLOB, HISTORY_JOB
+
+    while HISTORY_BLOB is None:
+        if HISTORY_JOB is None:
+            frame = b'{"type": "history", "messages": [' + b", ".join(CHAT_HISTORY_JSON) + b"]}"
+            if len(frame) < COMPRESS_OFFLOAD_BYTES:
+                # Small enough to compress inline; no task or thread hop needed
+                HISTORY_BLOB = zlib.compress(frame, COMPRESSION_LEVEL)
+                break
+            HISTORY_JOB = asyncio.create_task(compress(frame))
+        job = HISTORY_JOB
+        # Shielded so one cancelled caller does not cancel everyone else's wait
+        blob = await asyncio.shield(job)
+        # deliver() drops the job if a message arrived while it was compressing
+        if HISTORY_JOB is job:
+            HISTORY_BLOB = blob
+    return HISTORY_BLOB
+
+async def writer(websocket, queue):
+    """Drains a client's send queue onto its socket."""
     try:
-        for message in CHAT_HISTORY:
-            await websocket.send(json.dumps(message))
+        while True:
+            payload = await queue.get()
+            await asyncio.wait_for(websocket.send(payload), timeout=SEND_TIMEOUT)
     except websockets.exceptions.ConnectionClosed:
         pass
+    except asyncio.TimeoutError:
+        logger.warning("Send timed out, dropping client %s", websocket.remote_address)
+        await websocket.close(code=1011)
+    except asyncio.CancelledError:
+        # Cancelled by unregister(); make sure an evicted client is disconnected
+        await websocket.close(code=1011)
+        raise
+
+async def register(websocket):
+    """Adds a new client, queues history and starts its writer."""
+    global CONNECTIONS_SNAPSHOT
+
+    queue = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+    if CHAT_HISTORY_JSON:
+        queue.put_nowait(await history_blob())
+
+    CONNECTIONS[id(websocket)] = (websocket, queue, asyncio.create_task(writer(websocket, queue)))
+    CONNECTIONS_SNAPSHOT = tuple(CONNECTIONS.values())
+    logger.info("Client connected from %s. Total: %d", websocket.remote_address, len(CONNECTIONS))
 
 async def unregister(websocket):
-    """Removes a client."""
-    if websocket in CONNECTIONS:
-        CONNECTIONS.remove(websocket)
-        print(f"[INFO] Client disconnected. Total: {len(CONNECTIONS)}")
+    """Removes a client and stops its writer."""
+    global CONNECTIONS_SNAPSHOT
+
+    client = CONNECTIONS.pop(id(websocket), None)
+    if client is not None:
+        CONNECTIONS_SNAPSHOT = tuple(CONNECTIONS.values())
+        _, _, writer_task = client
+        writer_task.cancel()
+        logger.info("Client disconnected. Total: %d", len(CONNECTIONS))
 
 async def broadcast(message):
-    """Sends a message to all connected clients."""
-    global CHAT_HISTORY
-    
-    # Update history
-    CHAT_HISTORY.append(message)
-    if len(CHAT_HISTORY) > MAX_HISTORY:
-        CHAT_HISTORY = CHAT_HISTORY[1:] 
+    """Sends a message to every client, on all instances when Redis is used."""
+    if SHUTTING_DOWN:
+        return
 
-    message_json = json.dumps(message)
-    
-    if CONNECTIONS:
-        send_tasks = [conn.send(message_json) for conn in CONNECTIONS]
-        results = await asyncio.gather(*send_tasks, return_exceptions=True)
-        
-        disconnected_clients = []
-        for websocket, result in zip(CONNECTIONS, results):
-            if isinstance(result, Exception):
-                disconnected_clients.append(websocket)
-                
-        for client in disconnected_clients:
-            await unregister(client)
+    message_json = encode_json(message)
+
+    if REDIS is None:
+        await deliver(message_json)
+        return
+
+    # Every instance, including this one, delivers it from the channel
+    try:
+        async with REDIS.pipeline(transaction=True) as pipe:
+            pipe.rpush(REDIS_HISTORY_KEY, message_json)
+            pipe.ltrim(REDIS_HISTORY_KEY, -MAX_HISTORY, -1)
+            pipe.publish(REDIS_CHANNEL, message_json)
+            await pipe.execute()
+    except aioredis.RedisError as e:
+        # The message is lost, but the sender stays connected
+        logger.error("Failed to publish message to Redis: %s", e)
+
+async def deliver(message_json):
+    """Records an encoded message and queues it for this instance's clients."""
+    global HISTORY_BLOB, HISTORY_JOB
+
+    # Update history (the deque drops the oldest entry once full)
+    CHAT_HISTORY_JSON.append(message_json)
+    HISTORY_BLOB = None
+    HISTORY_JOB = None
+
+    # Only reachable via relay(): an instance with no local clients still keeps
+    # the shared history but has no reason to compress the frame
+    if not CONNECTIONS_SNAPSHOT:
+        return
+
+    payload = await compress(message_json)
+
+    # websockets.broadcast() would write straight to every transport, but it
+    # buffers without limit for slow clients; the bounded queues evict them.
+    slow_clients = []
+    for websocket, queue, _ in CONNECTIONS_SNAPSHOT:
+        try:
+            queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            slow_clients.append(websocket)
+
+    for client in slow_clients:
+        logger.warning("Dropping slow client %s", client.remote_address)
+        await unregister(client)
+
+async def subscribe():
+    """Subscribes to the broadcast channel and reloads the shared history.
+
+    Returns the subscription and the set of payloads just loaded, which
+    relay() uses to skip anything published before the LRANGE ran.
+    """
+    global HISTORY_BLOB, HISTORY_JOB
+
+    pubsub = REDIS.pubsub()
+    # Subscribe before reading history so nothing published in between is missed
+    await pubsub.subscribe(REDIS_CHANNEL)
+    history = await REDIS.lrange(REDIS_HISTORY_KEY, -MAX_HISTORY, -1)
+
+    CHAT_HISTORY_JSON.clear()
+    CHAT_HISTORY_JSON.extend(history)
+    HISTORY_BLOB = None
+    HISTORY_JOB = None
+    return pubsub, set(history)
+
+async def relay(pubsub, seeded):
+    """Delivers messages published by any instance to local clients."""
+    while True:
+        try:
+            if pubsub is None:
+                pubsub, seeded = await subscribe()
+                logger.info("Resubscribed to Redis")
+            async for item in pubsub.listen():
+                if item["type"] != "message":
+                    continue
+                if seeded:
+                    # Published between SUBSCRIBE and LRANGE, so already in history
+                    if item["data"] in seeded:
+                        continue
+                    seeded = None
+                await deliver(item["data"])
+        except aioredis.RedisError as e:
+            logger.error("Lost Redis subscription, retrying in %s seconds: %s", REDIS_RETRY_SECONDS, e)
+            await asyncio.sleep(REDIS_RETRY_SECONDS)
+
+        # Start over on a fresh subscription; history is reloaded to cover the gap
+        if pubsub is not None:
+            with suppress(aioredis.RedisError):
+                await pubsub.aclose()
+            pubsub = None
+
+async def connect_redis():
+    """Connects to Redis, loads shared history and starts the relay task."""
+    global REDIS
+
+    REDIS = aioredis.from_url(REDIS_URL)
+    return asyncio.create_task(relay(*await subscribe()))
+
+def shutdown(stop):
+    """Stops new work and wakes main() to close the server."""
+    global SHUTTING_DOWN
+
+    SHUTTING_DOWN = True
+    logger.info("Shutting down")
+    if not stop.done():
+        stop.set_result(None)
 
 async def handler(websocket, path):
     """Handles connection, message receiving, and disconnection."""
+    if SHUTTING_DOWN:
+        return
+
     await register(websocket)
     
     try:
         async for raw_message in websocket:
             try:
-                message = json.loads(raw_message)
-                
-                if all(key in message for key in ["user", "text"]) and message["text"].strip():
-                    message["text"] = message["text"].strip()
-                    message["timestamp"] = asyncio.get_event_loop().time()
-                    await broadcast(message)
+                message = decode_json(raw_message)
+                if not isinstance(message, dict):
+                    continue
+
+                user = message.get("user")
+                text = message.get("text")
+                if isinstance(user, str) and isinstance(text, str) and len(user) <= MAX_USERNAME_LENGTH:
+                    text = text.strip()
+                    if text:
+                        # Rebuilt so clients can't smuggle extra keys (e.g. "type") to everyone
+                        await broadcast({"user": user, "text": text, "timestamp": time()})
                 
             except json.JSONDecodeError:
-                print(f"[WARNING] Received invalid JSON from {websocket.remote_address}")
+                logger.warning("Received invalid JSON from %s", websocket.remote_address)
 
     except (websockets.exceptions.ConnectionClosedOK, websockets.exceptions.ConnectionClosedError) as e:
-        print(f"[INFO] Connection closed by {websocket.remote_address}: {e.__class__.__name__}")
+        logger.info("Connection closed by %s: %s", websocket.remote_address, e.__class__.__name__)
     except Exception as e:
-        print(f"[FATAL] Unhandled exception in handler: {e}")
+        logger.error("Unhandled exception in handler: %s", e)
         
     finally:
         await unregister(websocket)
 
 async def main():
     """Starts the WebSocket server."""
-    print(f"🌍 Starting Global Chat Server on {HOST}:{PORT}")
+    LOG_LISTENER.start()
+    relay_task = None
+    stop = asyncio.get_running_loop().create_future()
+    with suppress(NotImplementedError):  # No signal handlers on Windows
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, shutdown, stop)
     try:
-        async with websockets.serve(handler, HOST, PORT):
-            await asyncio.Future() 
+        if REDIS_URL:
+            if aioredis is None:
+                logger.critical("REDIS_URL is set but the redis package is not installed")
+                return
+            try:
+                relay_task = await connect_redis()
+            except aioredis.RedisError as e:
+                logger.critical("Failed to connect to Redis. Error: %s", e)
+                return
+            logger.info("Sharing chat state through Redis")
+
+        logger.info("🌍 Starting Global Chat Server on %s:%d", HOST, PORT)
+        # Clients must not rely on permessage-deflate (frames are compressed
+        # up front) and must keep each message under MAX_MSG_BYTES.
+        async with websockets.serve(
+            handler,
+            HOST,
+            PORT,
+            compression=None,
+            max_size=MAX_MSG_BYTES,
+            max_queue=32,
+            ping_interval=30,
+            ping_timeout=30,
+            write_limit=2**16,
+        ):
+            await stop
     except OSError as e:
-        print(f"[FATAL] Failed to bind to port {PORT}. Error: {e}")
+        logger.critical("Failed to bind to port %d. Error: %s", PORT, e)
+    finally:
+        if relay_task is not None:
+            relay_task.cancel()
+        if REDIS is not None:
+            await REDIS.aclose()
+        COMPRESS_POOL.shutdown()
+        LOG_LISTENER.stop()
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
     try:
         asyncio.run(main())
     except KeyboardInterrupt: